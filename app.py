@@ -1,17 +1,29 @@
 import os
 import shutil
 import sqlite3
-import json
 import re
+import hashlib
+import threading
+import asyncio
+import functools
+import bisect
+import mmap
+import time
 from pathlib import Path
+from uuid import uuid4
 from datetime import datetime
-from fastapi import FastAPI, UploadFile, File, Form
-from fastapi.responses import HTMLResponse, JSONResponse
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
+import aiofiles
+import orjson
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import joblib
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
 
 load_dotenv()
 
@@ -21,7 +33,13 @@ if not gemini_api_key:
     raise ValueError("GOOGLE_API_KEY no está configurada en .env")
 
 import google.generativeai as genai
-import pdfplumber
+
+# PDFium extrae texto en C; pdfplumber queda solo como respaldo
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+    import pdfplumber
 
 genai.configure(api_key=gemini_api_key)
 model = genai.GenerativeModel('gemini-2.5-flash')
@@ -30,10 +48,35 @@ model = genai.GenerativeModel('gemini-2.5-flash')
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 
+# Directorios de tenants eliminados, a la espera de borrarse en segundo plano
+TRASH_DIR = DATA_DIR / ".trash"
+TRASH_SWEEP_INTERVAL = 30
+
 DB_DIR = Path("db")
 DB_DIR.mkdir(exist_ok=True)
 
-app = FastAPI(title="GAMDEL RAG MVP - v5.2 (Gemini)")
+# Máximo de caracteres del documento que se envían a Gemini por pregunta
+MAX_CONTEXT_CHARS = 8000
+
+# Fragmentos del documento (en bytes del .txt) que se comparan con la pregunta
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+CONTEXT_CHUNKS = 3
+CHUNK_SNAP = 64  # bytes que se avanza como máximo para cortar en un espacio
+
+# Similitud mínima para aceptar un documento por contenido. Con bigramas y 2**18
+# columnas los documentos largos dan valores bajos: en los PDFs de ejemplo las
+# preguntas reales puntúan desde ~0.03 y las ajenas que comparten una palabra
+# suelta hasta ~0.015; el umbral queda en medio (tests/test_retrieval.py lo fija)
+SIMILARITY_THRESHOLD = 0.02
+
+# Patrones compilados una sola vez (códigos de documento y referencias sospechosas)
+CODE_RE = re.compile(r'(GAM-SIG-PR-\d+|DESPA-PG-\d+|G_\d{3}_\d{4}|[A-Z]+-[A-Z]+-\d+)', re.IGNORECASE)
+WORD_RE = re.compile(r'[^\W_]+')
+SPACE_RE = re.compile(rb'\s')
+HALLUC_RE = re.compile(r'GAM-SIG-PR-\d+|DESPA-PG|G_\d{3}_\d{4}|\b\S+?\.pdf\b', re.IGNORECASE)
+
+app = FastAPI(title="GAMDEL RAG MVP - v5.2 (Gemini)", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -43,233 +86,905 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-DOCUMENTS_CACHE = {}
-EMBEDDINGS_CACHE = {}
-VECTORIZERS_CACHE = {}
+DOCUMENTS_CACHE = {}  # tenant -> {nombre del PDF: ruta del .txt extraído}
+EMBEDDINGS_CACHE = {}  # tenant -> matriz TF-IDF normalizada (una fila por documento)
+COUNTS_CACHE = {}  # tenant -> conteos de términos sin ponderar, reutilizables al reajustar el IDF
+TRANSFORMERS_CACHE = {}  # tenant -> TfidfTransformer ajustado sobre los conteos
+KNOWN_TERMS = {}  # tenant -> máscara de columnas que aparecen en algún documento
+DOC_NAMES_CACHE = {}  # tenant -> nombres en el orden de las filas del índice
+DOC_INDEX = {}  # tenant -> {nombre: fila del índice}
+DOC_HASHES = {}  # tenant -> {nombre: SHA-1 del texto con que se vectorizó}
+DOC_STATS = {}  # tenant -> {nombre: {"chars": caracteres, "pages": páginas con texto}}
+CORPUS_VERSION = {}  # tenant -> contador que cambia con cada modificación del índice
+ANSWER_CACHE = OrderedDict()  # (tenant, versión, hash de la pregunta) -> (expira, respuesta)
+ANSWER_CACHE_SIZE = 1024
+ANSWER_CACHE_TTL = 3600  # segundos
+NAME_INDEX = {}
+NAME_BLOB = {}  # tenant -> (nombres en minúsculas unidos, nombres, posición de inicio de cada uno)
+CODE_INDEX = {}
+WORD_INDEX = {}
+BACKGROUND_TASKS = []
+INDEXING_STATUS = Counter()  # tenant -> indexaciones en curso
+TENANT_LOCKS = {}  # tenant -> RLock que serializa la carga y las modificaciones de su índice
+
+# Pool de procesos para extraer PDFs (los workers se crean bajo demanda)
+PDF_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())
+PAGES_PER_TASK = 16  # páginas por tarea al repartir un PDF entre los procesos
 
 # ============= EXTRACCIÓN DE TEXTO =============
-def extract_text_from_pdf(file_path: str):
-    """Extrae texto de PDF usando pdfplumber"""
-    text = ""
-    page_count = 0
-    
+def file_fingerprint(file_path: str) -> str:
+    """Calcula el SHA-256 del contenido de un archivo"""
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+async def save_upload(upload: UploadFile, out_path: Path) -> str:
+    """Guarda el archivo subido por bloques con E/S asíncrona y devuelve su SHA-256"""
+    h = hashlib.sha256()
+    async with aiofiles.open(out_path, 'wb') as f:
+        while block := await upload.read(1 << 20):
+            h.update(block)
+            await f.write(block)
+    return h.hexdigest()
+
+def count_pdf_pages(file_path: str) -> int:
+    """Cuenta las páginas de un PDF sin extraer su texto (ejecutable en el pool)"""
     try:
+        if pdfium is not None:
+            pdf = pdfium.PdfDocument(file_path)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
         with pdfplumber.open(file_path) as pdf:
-            page_count = len(pdf.pages)
-            for page_num, page in enumerate(pdf.pages):
-                try:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += f"\n--- Página {page_num + 1} ---\n"
-                        text += page_text
-                except Exception as e:
-                    pass
+            return len(pdf.pages)
     except Exception as e:
-        pass
+        print(f"  ❌ Error abriendo {Path(file_path).name}: {e}")
+        return 0
+
+def parse_pdf_pages(job: tuple) -> str:
+    """Extrae el texto de las páginas [inicio, fin) de un PDF (ejecutable en el pool)"""
+    file_path, start, end = job
+    parts = []
     
-    return text, page_count
+    try:
+        if pdfium is not None:
+            pdf = pdfium.PdfDocument(file_path)
+            try:
+                for page_num in range(start, end):
+                    try:
+                        page = pdf[page_num]
+                        textpage = page.get_textpage()
+                        page_text = textpage.get_text_range().replace("\r\n", "\n")
+                        textpage.close()
+                        page.close()
+                        if page_text:
+                            parts.append(f"\n--- Página {page_num + 1} ---\n")
+                            parts.append(page_text)
+                    except Exception as e:
+                        pass
+            finally:
+                pdf.close()
+        else:
+            with pdfplumber.open(file_path) as pdf:
+                for page_num in range(start, end):
+                    try:
+                        page_text = pdf.pages[page_num].extract_text()
+                        if page_text:
+                            parts.append(f"\n--- Página {page_num + 1} ---\n")
+                            parts.append(page_text)
+                    except Exception as e:
+                        pass
+    except Exception as e:
+        print(f"  ❌ Error en {Path(file_path).name}: {e}")
+    
+    return "".join(parts)
 
-def load_documents_from_disk():
-    """Carga documentos del disco en memoria"""
-    print("🔄 Cargando documentos del disco...")
-    if not DATA_DIR.exists():
-        print("⚠️ Directorio data no existe")
-        return
+def read_cached_text(tenant: str, content_hash: str):
+    """Devuelve (texto, páginas) de la caché por huella SHA-256, o None"""
+    cache_path = DB_DIR / tenant / "cache" / f"{content_hash}.json"
+    if not cache_path.exists():
+        return None
     
-    for tenant_dir in DATA_DIR.iterdir():
-        if not tenant_dir.is_dir():
+    try:
+        with open(cache_path, 'rb') as f:
+            cached = orjson.loads(f.read())
+        return cached["text"], cached["page_count"]
+    except Exception as e:
+        print(f"  ⚠️ Caché inválida {cache_path.name}: {e}")
+        return None
+
+def write_cached_text(tenant: str, content_hash: str, text: str, page_count: int):
+    """Guarda de forma atómica el texto extraído en la caché del tenant"""
+    cache_path = DB_DIR / tenant / "cache" / f"{content_hash}.json"
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps({"text": text, "page_count": page_count}))
+    os.replace(tmp_path, cache_path)
+
+def delete_cached_text(tenant: str, content_hash: str):
+    """Elimina de la caché del tenant el texto extraído de un PDF"""
+    (DB_DIR / tenant / "cache" / f"{content_hash}.json").unlink(missing_ok=True)
+
+def plan_pdf_extraction(jobs: list):
+    """Resuelve desde la caché lo posible y divide el resto en tareas por rango de páginas"""
+    plans = []
+    uncached = []
+    for file_path, tenant, content_hash in jobs:
+        content_hash = content_hash or file_fingerprint(file_path)
+        cached = read_cached_text(tenant, content_hash) if tenant else None
+        if cached is not None:
+            plans.append({"cached": cached})
+        else:
+            plans.append({"tenant": tenant, "content_hash": content_hash})
+            uncached.append((file_path, plans[-1]))
+    
+    # PDFium no es seguro entre hilos: también las páginas se cuentan en el pool de procesos
+    page_counts = PDF_POOL.map(count_pdf_pages, [file_path for file_path, _ in uncached])
+    
+    tasks = []
+    for (file_path, plan), page_count in zip(uncached, page_counts):
+        # Los PDFs grandes se reparten en varias tareas para usar todos los núcleos
+        first_task = len(tasks)
+        for start in range(0, page_count, PAGES_PER_TASK):
+            tasks.append((file_path, start, min(start + PAGES_PER_TASK, page_count)))
+        plan["page_count"] = page_count
+        plan["tasks"] = slice(first_task, len(tasks))
+    return plans, tasks
+
+def finish_pdf_extraction(plans: list, task_results: list) -> list:
+    """Une los rangos de páginas de cada PDF y guarda los textos nuevos en la caché"""
+    results = []
+    for plan in plans:
+        if "cached" in plan:
+            results.append(plan["cached"])
             continue
-            
-        tenant = tenant_dir.name
-        DOCUMENTS_CACHE[tenant] = {}
         
-        # Cargar archivos .txt primero
+        text = "".join(task_results[plan["tasks"]])
+        if plan["tenant"] and text.strip():
+            write_cached_text(plan["tenant"], plan["content_hash"], text, plan["page_count"])
+        results.append((text, plan["page_count"]))
+    return results
+
+def extract_pdfs_parallel(jobs: list):
+    """Extrae varios PDFs (ruta, tenant, hash) en paralelo con el pool de procesos compartido"""
+    plans, tasks = plan_pdf_extraction(jobs)
+    task_results = list(PDF_POOL.map(parse_pdf_pages, tasks))
+    return finish_pdf_extraction(plans, task_results)
+
+def write_document_text(txt_path: Path, text_content: str) -> Path:
+    """Guarda el texto extraído junto al PDF y devuelve su ruta"""
+    # Se reemplaza el archivo en lugar de truncarlo: puede estar mapeado en memoria
+    tmp_path = txt_path.with_suffix(".txt.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text_content)
+    os.replace(tmp_path, txt_path)
+    return txt_path
+
+@functools.lru_cache(maxsize=32)
+def read_document_text(txt_path: str, mtime_ns: int) -> str:
+    """Lee el texto de un documento (LRU; la fecha de modificación invalida la entrada)"""
+    with open(txt_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def get_document_text(tenant: str, doc_name: str) -> str:
+    """Devuelve el texto de un documento leyéndolo bajo demanda desde su .txt"""
+    txt_path = DOCUMENTS_CACHE[tenant][doc_name]
+    return read_document_text(str(txt_path), txt_path.stat().st_mtime_ns)
+
+@functools.lru_cache(maxsize=32)
+def map_document_text(txt_path: str, mtime_ns: int):
+    """Mapea en memoria el .txt de un documento (LRU; la fecha de modificación invalida la entrada)"""
+    with open(txt_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def get_document_map(tenant: str, doc_name: str):
+    """Devuelve los bytes UTF-8 del texto de un documento sin decodificarlo completo"""
+    txt_path = DOCUMENTS_CACHE[tenant][doc_name]
+    return map_document_text(str(txt_path), txt_path.stat().st_mtime_ns)
+
+def decode_range(buf, start: int, end: int) -> str:
+    """Decodifica un rango de bytes (los cortes a mitad de carácter se descartan)"""
+    return buf[start:end].decode('utf-8', errors='ignore')
+
+def load_tenant(tenant: str):
+    """Carga en memoria solo los documentos de un tenant"""
+    with tenant_lock(tenant):
+        tenant_dir = DATA_DIR / tenant
+        if not tenant_dir.is_dir():
+            return
+        
+        print(f"🔄 Cargando documentos de '{tenant}' del disco...")
+        # Se arma aparte y se publica al final: nadie debe ver el tenant a medio cargar
+        docs = {}
+        
+        # Registrar los .txt ya extraídos (el texto se lee bajo demanda)
         txt_files = sorted(tenant_dir.glob("*.txt"))
         for txt_file in txt_files:
-            try:
-                with open(txt_file, 'r', encoding='utf-8') as f:
-                    text_content = f.read()
-                
-                pdf_name = txt_file.stem + ".pdf"
-                DOCUMENTS_CACHE[tenant][pdf_name] = text_content
-                print(f"  ✅ {pdf_name}: {len(text_content)} chars")
-            except Exception as e:
-                print(f"  ❌ Error en {txt_file.name}: {e}")
+            pdf_name = txt_file.stem + ".pdf"
+            docs[pdf_name] = txt_file
+            print(f"  ✅ {pdf_name}: {txt_file.stat().st_size} bytes")
         
-        # Cargar PDFs
+        # PDFs sin texto extraído: se procesan todos juntos en paralelo
+        pending = []
         pdf_files = sorted(tenant_dir.glob("*.pdf"))
         for pdf_file in pdf_files:
-            pdf_name = pdf_file.name
-            
-            if pdf_name in DOCUMENTS_CACHE[tenant]:
-                continue
-            
-            try:
+            if pdf_file.name not in docs:
                 print(f"  📖 Procesando {pdf_file.name}...")
-                text_content, page_count = extract_text_from_pdf(str(pdf_file))
-                
-                if text_content.strip():
-                    DOCUMENTS_CACHE[tenant][pdf_file.name] = text_content
-                    print(f"  ✅ {pdf_file.name}: {len(text_content)} chars")
-            except Exception as e:
-                print(f"  ❌ Error en {pdf_file.name}: {e}")
+                pending.append(pdf_file)
+        
+        jobs = [(str(pdf_file), tenant, None) for pdf_file in pending]
+        for pdf_file, (text_content, page_count) in zip(pending, extract_pdfs_parallel(jobs)):
+            if text_content.strip():
+                txt_path = write_document_text(tenant_dir / (pdf_file.stem + ".txt"), text_content)
+                docs[pdf_file.name] = txt_path
+                print(f"  ✅ {pdf_file.name}: {len(text_content)} chars")
         
-        if DOCUMENTS_CACHE[tenant]:
-            create_embeddings(tenant)
-            print(f"✅ Tenant '{tenant}': {len(DOCUMENTS_CACHE[tenant])} documentos cargados")
+        if docs:
+            if load_embeddings(tenant, docs):
+                print(f"  ⚡ Índice vectorial de '{tenant}' cargado desde disco")
+            else:
+                build_embeddings(tenant, docs)
+        
+        DOCUMENTS_CACHE[tenant] = docs
+        if docs:
+            print(f"✅ Tenant '{tenant}': {len(docs)} documentos cargados")
+
+def ensure_tenant_loaded(tenant: str):
+    """Carga el tenant si aún no está en memoria (una sola vez aunque lleguen varias peticiones)"""
+    with tenant_lock(tenant):
+        if tenant not in DOCUMENTS_CACHE:
+            load_tenant(tenant)
+
+def load_documents_from_disk():
+    """Recarga del disco los documentos de todos los tenants"""
+    print("🔄 Cargando documentos del disco...")
+    if not DATA_DIR.exists():
+        print("⚠️ Directorio data no existe")
+        return
+    
+    tenant_dirs = [d for d in DATA_DIR.iterdir() if d.is_dir() and not d.name.startswith(".")]
+    
+    # PDFs sin texto de todos los tenants: se extraen juntos en el pool
+    pending = [
+        pdf_file
+        for tenant_dir in tenant_dirs
+        for pdf_file in sorted(tenant_dir.glob("*.pdf"))
+        if not pdf_file.with_suffix(".txt").exists()
+    ]
+    jobs = [(str(pdf_file), pdf_file.parent.name, None) for pdf_file in pending]
+    for pdf_file, (text_content, page_count) in zip(pending, extract_pdfs_parallel(jobs)):
+        if text_content.strip():
+            write_document_text(pdf_file.with_suffix(".txt"), text_content)
+    
+    for tenant_dir in tenant_dirs:
+        load_tenant(tenant_dir.name)
+
+async def trash_collector():
+    """Borra periódicamente los directorios movidos a la papelera"""
+    while True:
+        if TRASH_DIR.exists():
+            for trash_entry in TRASH_DIR.iterdir():
+                await asyncio.to_thread(shutil.rmtree, trash_entry, ignore_errors=True)
+        await asyncio.sleep(TRASH_SWEEP_INTERVAL)
 
 @app.on_event("startup")
 async def startup_event():
     """Inicia el servidor"""
     print("🚀 Iniciando GAMDEL Chatbot v5.2 (con Google Gemini)...")
+    BACKGROUND_TASKS.append(asyncio.create_task(conversation_writer()))
+    BACKGROUND_TASKS.append(asyncio.create_task(trash_collector()))
     print("✅ Servidor iniciado. Los documentos se cargarán bajo demanda.")
 
-# ============= BASE DE DATOS =============
-def init_db(tenant: str):
-    """Inicializa la base de datos para un tenant"""
-    db_path = DB_DIR / f"{tenant}.db"
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT,
-            user_question TEXT,
-            assistant_response TEXT,
-            sources TEXT
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS documents (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            filename TEXT UNIQUE,
-            upload_date TEXT,
-            file_size INTEGER,
-            page_count INTEGER
-        )
-    ''')
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Libera recursos al detener el servidor"""
+    for task in BACKGROUND_TASKS:
+        task.cancel()
+    await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+    BACKGROUND_TASKS.clear()
     
-    conn.commit()
-    conn.close()
+    flush_conversations()
+    close_all_connections()
+    PDF_POOL.shutdown(cancel_futures=True)
 
-def save_document_metadata(tenant: str, filename: str, file_size: int, page_count: int):
-    """Guarda metadatos del documento en la BD"""
-    db_path = DB_DIR / f"{tenant}.db"
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT OR REPLACE INTO documents (filename, upload_date, file_size, page_count)
-        VALUES (?, ?, ?, ?)
-    ''', (filename, datetime.now().isoformat(), file_size, page_count))
+# ============= BASE DE DATOS =============
+DB_CONNS = {}
+DB_LOCK = threading.RLock()
+
+CONVERSATION_QUEUE = asyncio.Queue()
+CONVERSATION_BATCH_SIZE = 100
+CONVERSATION_FLUSH_INTERVAL = 0.1
+
+def get_conn(tenant: str) -> sqlite3.Connection:
+    """Devuelve la conexión SQLite reutilizable del tenant (modo WAL)"""
+    with DB_LOCK:
+        conn = DB_CONNS.get(tenant)
+        if conn is None:
+            conn = sqlite3.connect(DB_DIR / f"{tenant}.db", check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA cache_size=-20000')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA mmap_size=268435456')
+            init_db(conn)
+            DB_CONNS[tenant] = conn
+        return conn
+
+def close_all_connections():
+    """Cierra las conexiones SQLite abiertas"""
+    with DB_LOCK:
+        for conn in DB_CONNS.values():
+            conn.close()
+        DB_CONNS.clear()
+
+def init_db(conn: sqlite3.Connection):
+    """Crea el esquema del tenant una sola vez, al abrir su conexión"""
+    with conn:
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp TEXT,
+                user_question TEXT,
+                assistant_response TEXT,
+                sources TEXT
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conv_ts ON conversations(timestamp DESC)')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                filename TEXT UNIQUE,
+                upload_date TEXT,
+                file_size INTEGER,
+                page_count INTEGER,
+                content_hash TEXT
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                cache_key TEXT PRIMARY KEY,
+                doc_name TEXT,
+                answer TEXT,
+                created_at TEXT
+            )
+        ''')
+        
+        # Migrar bases de datos creadas antes de la columna content_hash
+        columns = [row[1] for row in cursor.execute('PRAGMA table_info(documents)')]
+        if 'content_hash' not in columns:
+            cursor.execute('ALTER TABLE documents ADD COLUMN content_hash TEXT')
+
+def save_document_metadata(tenant: str, rows: list):
+    """Guarda en una sola transacción los metadatos (filename, file_size, page_count, content_hash)"""
+    upload_date = datetime.now().isoformat()
+    with DB_LOCK, get_conn(tenant) as conn:
+        conn.executemany('''
+            INSERT OR REPLACE INTO documents (filename, upload_date, file_size, page_count, content_hash)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(filename, upload_date, file_size, page_count, content_hash)
+              for filename, file_size, page_count, content_hash in rows])
+
+def get_document_hash(tenant: str, filename: str):
+    """Obtiene la huella SHA-256 registrada para un documento"""
+    with DB_LOCK:
+        row = get_conn(tenant).execute(
+            'SELECT content_hash FROM documents WHERE filename = ?', (filename,)
+        ).fetchone()
     
-    conn.commit()
-    conn.close()
+    return row[0] if row else None
+
+def delete_document_metadata(tenant: str, filename: str):
+    """Elimina los metadatos de un documento"""
+    with DB_LOCK, get_conn(tenant) as conn:
+        conn.execute('DELETE FROM documents WHERE filename = ?', (filename,))
+        conn.execute('DELETE FROM answer_cache WHERE doc_name = ?', (filename,))
+
+def delete_tenant_data(tenant: str):
+    """Vacía en una sola transacción las conversaciones, los metadatos y las respuestas guardadas del tenant"""
+    with DB_LOCK, get_conn(tenant) as conn:
+        conn.execute('DELETE FROM conversations')
+        conn.execute('DELETE FROM documents')
+        conn.execute('DELETE FROM answer_cache')
 
 def get_documents(tenant: str):
     """Obtiene lista de documentos de la BD"""
-    db_path = DB_DIR / f"{tenant}.db"
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT filename, upload_date, file_size, page_count FROM documents ORDER BY upload_date DESC')
-    docs = cursor.fetchall()
-    conn.close()
+    with DB_LOCK:
+        docs = get_conn(tenant).execute(
+            'SELECT filename, upload_date, file_size, page_count FROM documents ORDER BY upload_date DESC'
+        ).fetchall()
     
     return docs
 
 def save_conversation(tenant: str, question: str, response: str, sources: list):
-    """Guarda la conversación en la BD"""
-    db_path = DB_DIR / f"{tenant}.db"
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        INSERT INTO conversations (timestamp, user_question, assistant_response, sources)
-        VALUES (?, ?, ?, ?)
-    ''', (datetime.now().isoformat(), question, response, json.dumps(sources)))
+    """Encola la conversación; se guarda en lote en segundo plano"""
+    CONVERSATION_QUEUE.put_nowait(
+        (tenant, datetime.now().isoformat(), question, response, orjson.dumps(sources).decode())
+    )
+
+def write_conversations(batch: list):
+    """Inserta un lote de conversaciones con una transacción por tenant"""
+    rows_by_tenant = {}
+    for tenant, *row in batch:
+        rows_by_tenant.setdefault(tenant, []).append(row)
     
-    conn.commit()
-    conn.close()
+    for tenant, rows in rows_by_tenant.items():
+        try:
+            with DB_LOCK, get_conn(tenant) as conn:
+                conn.executemany('''
+                    INSERT INTO conversations (timestamp, user_question, assistant_response, sources)
+                    VALUES (?, ?, ?, ?)
+                ''', rows)
+        except Exception as e:
+            print(f"❌ Error guardando {len(rows)} conversaciones de '{tenant}': {e}")
+
+async def conversation_writer():
+    """Vacía la cola de conversaciones en lotes de hasta N filas o 100 ms"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = []
+        try:
+            batch.append(await CONVERSATION_QUEUE.get())
+            deadline = loop.time() + CONVERSATION_FLUSH_INTERVAL
+            
+            while len(batch) < CONVERSATION_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(CONVERSATION_QUEUE.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Al apagar, el lote ya sacado de la cola no debe perderse
+            if batch:
+                write_conversations(batch)
+            raise
+        
+        await asyncio.to_thread(write_conversations, batch)
+
+def flush_conversations():
+    """Guarda de inmediato las conversaciones pendientes en la cola"""
+    batch = []
+    while not CONVERSATION_QUEUE.empty():
+        batch.append(CONVERSATION_QUEUE.get_nowait())
+    if batch:
+        write_conversations(batch)
 
 def get_conversation_history(tenant: str, limit: int = 10):
     """Obtiene el historial de conversaciones"""
-    db_path = DB_DIR / f"{tenant}.db"
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT timestamp, user_question, assistant_response, sources 
-        FROM conversations 
-        ORDER BY timestamp DESC 
-        LIMIT ?
-    ''', (limit,))
-    
-    history = cursor.fetchall()
-    conn.close()
+    with DB_LOCK:
+        history = get_conn(tenant).execute('''
+            SELECT timestamp, user_question, assistant_response, sources 
+            FROM conversations 
+            ORDER BY timestamp DESC 
+            LIMIT ?
+        ''', (limit,)).fetchall()
     
     return history
 
+def get_stored_answer(tenant: str, cache_key: str):
+    """Obtiene una respuesta de Gemini guardada para la clave dada"""
+    with DB_LOCK:
+        row = get_conn(tenant).execute(
+            'SELECT answer FROM answer_cache WHERE cache_key = ?', (cache_key,)
+        ).fetchone()
+    
+    return row[0] if row else None
+
+def store_answer(tenant: str, cache_key: str, doc_name: str, answer: str):
+    """Guarda una respuesta de Gemini para reutilizarla entre reinicios"""
+    with DB_LOCK, get_conn(tenant) as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO answer_cache (cache_key, doc_name, answer, created_at)
+            VALUES (?, ?, ?, ?)
+        ''', (cache_key, doc_name, answer, datetime.now().isoformat()))
+
 # ============= BÚSQUEDA Y EMBEDDINGS =============
-def create_embeddings(tenant: str):
-    """Crea embeddings TF-IDF para los documentos"""
-    if tenant not in DOCUMENTS_CACHE or not DOCUMENTS_CACHE[tenant]:
+# Palabras vacías en español (scikit-learn solo incluye una lista en inglés)
+SPANISH_STOPWORDS = [
+    'al', 'algo', 'algunas', 'algunos', 'ante', 'antes', 'como', 'con', 'contra', 'cual', 'cuando',
+    'de', 'del', 'desde', 'donde', 'durante', 'el', 'ella', 'ellas', 'ellos', 'en', 'entre', 'era',
+    'eran', 'es', 'esa', 'esas', 'ese', 'eso', 'esos', 'esta', 'estaba', 'estado', 'estas', 'este',
+    'esto', 'estos', 'está', 'están', 'fue', 'fueron', 'ha', 'han', 'hasta', 'hay', 'la', 'las',
+    'le', 'les', 'lo', 'los', 'mas', 'me', 'mi', 'mis', 'mismo', 'mucho', 'muy', 'más', 'nada',
+    'ni', 'no', 'nos', 'nosotros', 'nuestra', 'nuestro', 'otra', 'otras', 'otro', 'otros', 'para',
+    'pero', 'poco', 'por', 'porque', 'que', 'quien', 'qué', 'se', 'sea', 'ser', 'si', 'sido', 'sin',
+    'sobre', 'son', 'su', 'sus', 'sí', 'también', 'tanto', 'te', 'tiene', 'tienen', 'todo', 'todos',
+    'tu', 'tus', 'un', 'una', 'uno', 'unos', 'usted', 'ustedes', 'ya', 'yo', 'él',
+]
+STOPWORDS_SET = frozenset(SPANISH_STOPWORDS)
+
+# Vectorizador sin estado compartido por todos los tenants: cuenta términos sin
+# vocabulario; el IDF de cada tenant se ajusta aparte sobre esos conteos
+VECTORIZER = HashingVectorizer(
+    n_features=2**18,
+    alternate_sign=False,
+    norm=None,
+    stop_words=SPANISH_STOPWORDS,
+    ngram_range=(1, 2),
+    dtype=np.float32,
+)
+
+def build_name_index(tenant: str, doc_names=None):
+    """Construye los índices por nombre, código y palabra de los documentos"""
+    if doc_names is None:
+        doc_names = DOCUMENTS_CACHE.get(tenant, {})
+    
+    name_index = {}
+    code_index = {}
+    word_index = defaultdict(set)
+    for doc_name in doc_names:
+        name_index[doc_name.lower()] = doc_name
+        for code in CODE_RE.findall(doc_name):
+            code_index.setdefault(code.lower(), doc_name)
+        for word in WORD_RE.findall(Path(doc_name).stem.lower()):
+            if len(word) > 2 and word not in STOPWORDS_SET:
+                word_index[word].add(doc_name)
+    
+    NAME_INDEX[tenant] = name_index
+    CODE_INDEX[tenant] = code_index
+    WORD_INDEX[tenant] = word_index
+    
+    # Todos los nombres en una sola cadena para buscar fragmentos con un solo str.find
+    starts = []
+    offset = 0
+    for lower in name_index:
+        starts.append(offset)
+        offset += len(lower) + 1
+    NAME_BLOB[tenant] = ("\x00".join(name_index), list(name_index.values()), starts)
+
+def find_name_containing(tenant: str, fragment: str):
+    """Devuelve el primer documento cuyo nombre (en minúsculas) contiene el fragmento"""
+    if not fragment or "\x00" in fragment:
+        return None
+    blob, names, starts = NAME_BLOB[tenant]
+    pos = blob.find(fragment)
+    if pos < 0:
         return None
+    return names[bisect.bisect_right(starts, pos) - 1]
+
+def embeddings_path(tenant: str) -> Path:
+    """Ruta del índice vectorial persistido del tenant"""
+    return DB_DIR / f"{tenant}.vectors.joblib"
+
+def text_hash(text: str) -> str:
+    """Huella del texto extraído para reutilizar su vector si no cambia"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def document_stats(text: str, mtime_ns: int = None) -> dict:
+    """Estadísticas del documento calculadas una sola vez al indexarlo (y la fecha de su .txt)"""
+    return {"chars": len(text), "pages": text.count("--- Página"), "mtime_ns": mtime_ns}
+
+def tenant_lock(tenant: str) -> threading.RLock:
+    """Lock del tenant para modificar sus documentos e índice desde cualquier hilo"""
+    return TENANT_LOCKS.setdefault(tenant, threading.RLock())
+
+def bump_corpus_version(tenant: str):
+    """Invalida las respuestas cacheadas del tenant"""
+    CORPUS_VERSION[tenant] = CORPUS_VERSION.get(tenant, 0) + 1
+
+def clear_embeddings(tenant: str):
+    """Descarta el índice vectorial del tenant en memoria y en disco"""
+    with tenant_lock(tenant):
+        bump_corpus_version(tenant)
+        for cache in (EMBEDDINGS_CACHE, COUNTS_CACHE, TRANSFORMERS_CACHE, KNOWN_TERMS, DOC_NAMES_CACHE, DOC_INDEX, DOC_HASHES, DOC_STATS):
+            cache.pop(tenant, None)
+        embeddings_path(tenant).unlink(missing_ok=True)
+
+def publish_index(tenant: str, counts, doc_names: list, doc_hashes: dict, doc_stats: dict):
+    """Reajusta el IDF sobre los conteos (sin volver a tokenizar) y publica el índice en memoria"""
+    transformer = TfidfTransformer(sublinear_tf=True).fit(counts)
+    EMBEDDINGS_CACHE[tenant] = transformer.transform(counts).astype(np.float32, copy=False)
+    COUNTS_CACHE[tenant] = counts
+    TRANSFORMERS_CACHE[tenant] = transformer
+    KNOWN_TERMS[tenant] = counts.getnnz(axis=0) > 0
+    DOC_NAMES_CACHE[tenant] = doc_names
+    DOC_INDEX[tenant] = {doc_name: row for row, doc_name in enumerate(doc_names)}
+    DOC_HASHES[tenant] = doc_hashes
+    DOC_STATS[tenant] = doc_stats
+    build_name_index(tenant, doc_names)
+
+def set_embeddings(tenant: str, counts, doc_names: list, doc_hashes: dict, doc_stats: dict):
+    """Publica el índice vectorial del tenant y lo persiste en disco"""
+    publish_index(tenant, counts, doc_names, doc_hashes, doc_stats)
+    bump_corpus_version(tenant)
+    
+    joblib.dump(
+        {
+            "doc_names": doc_names,
+            "doc_hashes": doc_hashes,
+            "doc_stats": doc_stats,
+            "counts": counts,
+            "n_features": VECTORIZER.n_features,
+        },
+        embeddings_path(tenant),
+        compress=0,
+    )
+
+def read_stored_embeddings(tenant: str):
+    """Lee el índice persistido del tenant (None si no existe o es de otro vectorizador)"""
+    path = embeddings_path(tenant)
+    if not path.exists():
+        return None
+    
+    try:
+        stored = joblib.load(path)
+    except Exception as e:
+        print(f"  ⚠️ Índice vectorial inválido para '{tenant}': {e}")
+        return None
+    
+    if stored.get("n_features") != VECTORIZER.n_features or "counts" not in stored:
+        return None
+    return stored
+
+def cached_doc_vectors(tenant: str) -> dict:
+    """Conteos ya calculados del tenant: {nombre: (hash del texto, estadísticas, fila CSR)}"""
+    if tenant in COUNTS_CACHE:
+        counts, doc_names = COUNTS_CACHE[tenant], DOC_NAMES_CACHE[tenant]
+        doc_hashes, doc_stats = DOC_HASHES[tenant], DOC_STATS[tenant]
+    else:
+        stored = read_stored_embeddings(tenant)
+        if stored is None:
+            return {}
+        counts, doc_names = stored["counts"], stored["doc_names"]
+        doc_hashes, doc_stats = stored.get("doc_hashes", {}), stored.get("doc_stats", {})
+    
+    return {
+        doc_name: (doc_hashes.get(doc_name), doc_stats.get(doc_name, {}), counts[row])
+        for row, doc_name in enumerate(doc_names)
+    }
+
+def build_embeddings(tenant: str, docs: dict = None):
+    """Vectoriza los documentos del tenant reutilizando las filas cuyo texto no cambió"""
+    with tenant_lock(tenant):
+        if docs is None:
+            docs = DOCUMENTS_CACHE.get(tenant, {})
+        if not docs:
+            clear_embeddings(tenant)
+            build_name_index(tenant, docs)
+            return None
+        
+        doc_names = list(docs.keys())
+        cached = cached_doc_vectors(tenant)
+        
+        rows = {}
+        doc_hashes = {}
+        doc_stats = {}
+        stale = []
+        for doc_name in doc_names:
+            # Si el .txt no cambió desde que se indexó, su fila se reutiliza sin leerlo
+            previous = cached.get(doc_name)
+            mtime_ns = docs[doc_name].stat().st_mtime_ns
+            if previous is not None and previous[0] and previous[1].get("mtime_ns") == mtime_ns:
+                doc_hashes[doc_name], doc_stats[doc_name], rows[doc_name] = previous
+            else:
+                stale.append(doc_name)
+        
+        def stale_texts():
+            """Lee los textos de uno en uno a medida que el vectorizador los consume"""
+            for doc_name in stale:
+                txt_path = docs[doc_name]
+                mtime_ns = txt_path.stat().st_mtime_ns
+                with open(txt_path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                doc_hashes[doc_name] = text_hash(text)
+                doc_stats[doc_name] = document_stats(text, mtime_ns)
+                yield text
+        
+        # Solo se tokenizan los documentos nuevos o modificados
+        if stale:
+            new_rows = VECTORIZER.transform(stale_texts())
+            for row, doc_name in enumerate(stale):
+                rows[doc_name] = new_rows[row]
+        
+        # Matriz dispersa (CSR) con una fila por documento
+        counts = sparse.vstack([rows[doc_name] for doc_name in doc_names], format='csr')
+        
+        set_embeddings(tenant, counts, doc_names, doc_hashes, doc_stats)
+        return EMBEDDINGS_CACHE[tenant]
+
+def add_doc_embeddings(tenant: str, new_docs: dict):
+    """Agrega (o reemplaza) filas al índice vectorizando solo los documentos nuevos"""
+    with tenant_lock(tenant):
+        # Los documentos borrados mientras esperaban su indexación no se agregan
+        docs = DOCUMENTS_CACHE.get(tenant, {})
+        new_docs = {name: text for name, text in new_docs.items() if name in docs}
+        if not new_docs:
+            return
+        if tenant not in COUNTS_CACHE:
+            build_embeddings(tenant)
+            return
+        
+        doc_names = [name for name in DOC_NAMES_CACHE[tenant] if name not in new_docs]
+        keep_rows = [DOC_INDEX[tenant][name] for name in doc_names]
+        new_rows = VECTORIZER.transform(list(new_docs.values()))
+        counts = sparse.vstack([COUNTS_CACHE[tenant][keep_rows], new_rows], format='csr')
+        
+        doc_hashes = {name: DOC_HASHES[tenant].get(name) for name in doc_names}
+        doc_hashes.update((name, text_hash(text)) for name, text in new_docs.items())
+        doc_stats = {name: DOC_STATS[tenant][name] for name in doc_names if name in DOC_STATS[tenant]}
+        doc_stats.update(
+            (name, document_stats(text, DOCUMENTS_CACHE[tenant][name].stat().st_mtime_ns))
+            for name, text in new_docs.items()
+        )
+        set_embeddings(tenant, counts, doc_names + list(new_docs), doc_hashes, doc_stats)
+
+def remove_doc_embedding(tenant: str, doc_name: str):
+    """Quita la fila de un documento del índice"""
+    with tenant_lock(tenant):
+        if doc_name not in DOC_INDEX.get(tenant, {}):
+            build_name_index(tenant)
+            return
+        if not DOCUMENTS_CACHE.get(tenant):
+            clear_embeddings(tenant)
+            build_name_index(tenant)
+            return
+        
+        doc_names = [name for name in DOC_NAMES_CACHE[tenant] if name != doc_name]
+        keep_rows = [DOC_INDEX[tenant][name] for name in doc_names]
+        doc_hashes = {name: DOC_HASHES[tenant].get(name) for name in doc_names}
+        doc_stats = {name: DOC_STATS[tenant][name] for name in doc_names if name in DOC_STATS[tenant]}
+        
+        set_embeddings(tenant, COUNTS_CACHE[tenant][keep_rows], doc_names, doc_hashes, doc_stats)
+
+def load_embeddings(tenant: str, docs: dict) -> bool:
+    """Carga el índice vectorial persistido si sigue vigente para los documentos del tenant"""
+    path = embeddings_path(tenant)
+    if not path.exists():
+        return False
     
-    texts = list(DOCUMENTS_CACHE[tenant].values())
+    # El índice debe ser más reciente que cualquier texto extraído
+    txt_mtimes = [txt_file.stat().st_mtime for txt_file in (DATA_DIR / tenant).glob("*.txt")]
+    if txt_mtimes and path.stat().st_mtime < max(txt_mtimes):
+        return False
     
-    vectorizer = TfidfVectorizer(max_features=500, stop_words='english')
-    embeddings = vectorizer.fit_transform(texts).toarray()
+    stored = read_stored_embeddings(tenant)
+    if stored is None:
+        return False
     
-    VECTORIZERS_CACHE[tenant] = vectorizer
-    EMBEDDINGS_CACHE[tenant] = embeddings
+    doc_names = stored["doc_names"]
+    if set(doc_names) != set(docs):
+        return False
     
-    return vectorizer, embeddings
+    publish_index(tenant, stored["counts"], doc_names, stored.get("doc_hashes", {}), stored.get("doc_stats", {}))
+    return True
+
+def query_vector(tenant: str, text: str):
+    """Vector TF-IDF normalizado de un texto con el IDF del tenant"""
+    vec = VECTORIZER.transform([text])
+    # Como con un vocabulario ajustado, se ignoran los términos que no aparecen en el corpus
+    vec.data *= KNOWN_TERMS[tenant][vec.indices]
+    vec.eliminate_zeros()
+    return TRANSFORMERS_CACHE[tenant].transform(vec)
 
 def search_relevant_documents(tenant: str, query: str, top_k: int = 1):
-    """Busca documentos - PRIMERO por código, LUEGO por nombre, LUEGO por contenido"""
+    """Busca documentos - PRIMERO por código, LUEGO por nombre y sus palabras, LUEGO por contenido"""
     if tenant not in DOCUMENTS_CACHE or not DOCUMENTS_CACHE[tenant]:
         return []
     
-    doc_names = list(DOCUMENTS_CACHE[tenant].keys())
+    if tenant not in NAME_INDEX:
+        build_name_index(tenant)
+    
+    name_index = NAME_INDEX[tenant]
     query_lower = query.lower()
     
     # PASO 1: Buscar por código (ej: GAM-SIG-PR-021, DESPA-PG, G_003_2026)
-    code_pattern = r'(GAM-SIG-PR-\d+|DESPA-PG-\d+|G_\d{3}_\d{4}|[A-Z]+-[A-Z]+-\d+)'
-    code_matches = re.findall(code_pattern, query, re.IGNORECASE)
-    
-    if code_matches:
-        for code in code_matches:
-            for doc_name in doc_names:
-                if code.lower() in doc_name.lower():
-                    print(f"✅ Encontrado por código '{code}': {doc_name}")
-                    return [doc_name]
+    for code in CODE_RE.findall(query):
+        code_lower = code.lower()
+        doc_name = CODE_INDEX[tenant].get(code_lower)
+        if doc_name is None:
+            doc_name = find_name_containing(tenant, code_lower)
+        if doc_name:
+            print(f"✅ Encontrado por código '{code}': {doc_name}")
+            return [doc_name]
     
     # PASO 2: Buscar por nombre de documento
-    for doc_name in doc_names:
-        if query_lower in doc_name.lower():
-            print(f"✅ Encontrado por nombre: {doc_name}")
+    doc_name = name_index.get(query_lower)
+    if doc_name is None:
+        doc_name = find_name_containing(tenant, query_lower)
+    if doc_name:
+        print(f"✅ Encontrado por nombre: {doc_name}")
+        return [doc_name]
+    
+    # PASO 3: Buscar por palabras del nombre (al menos 2 coincidencias)
+    word_index = WORD_INDEX[tenant]
+    hits = Counter()
+    for word in set(WORD_RE.findall(query_lower)) - STOPWORDS_SET:
+        hits.update(word_index.get(word, ()))
+    if hits:
+        doc_name, count = hits.most_common(1)[0]
+        if count >= 2:
+            print(f"✅ Encontrado por palabras del nombre: {doc_name}")
             return [doc_name]
     
-    # PASO 3: Búsqueda por contenido (TF-IDF)
-    if tenant not in VECTORIZERS_CACHE or tenant not in EMBEDDINGS_CACHE:
+    # PASO 4: Búsqueda por contenido (similitud coseno)
+    if tenant not in EMBEDDINGS_CACHE:
         return []
     
-    vectorizer = VECTORIZERS_CACHE[tenant]
     embeddings = EMBEDDINGS_CACHE[tenant]
+    doc_names = DOC_NAMES_CACHE[tenant]
     
     try:
-        query_vec = vectorizer.transform([query]).toarray()
-        similarities = cosine_similarity(query_vec, embeddings)[0]
-        top_indices = np.argsort(similarities)[::-1][:top_k]
+        # Las filas están normalizadas con L2, así que el producto punto es la similitud coseno
+        query_vec = query_vector(tenant, query)
+        similarities = (embeddings @ query_vec.T).toarray().ravel()
+        if top_k == 1:
+            top_indices = [int(similarities.argmax())]
+        else:
+            top_k = min(top_k, len(similarities))
+            top_indices = np.argpartition(similarities, -top_k)[-top_k:]
+            top_indices = top_indices[np.argsort(similarities[top_indices])[::-1]]
         
-        results = [doc_names[i] for i in top_indices if similarities[i] > 0.1]
+        results = [doc_names[i] for i in top_indices if similarities[i] > SIMILARITY_THRESHOLD]
         return results if results else []
     except:
         return []
 
+def snap_to_space(buf, pos: int) -> int:
+    """Avanza una posición hasta el siguiente espacio para no cortar palabras"""
+    if pos >= len(buf):
+        return len(buf)
+    match = SPACE_RE.search(buf, pos, min(pos + CHUNK_SNAP, len(buf)))
+    return match.start() if match else pos
+
+def chunk_spans(buf) -> list:
+    """Divide el texto en ventanas solapadas de unos CHUNK_SIZE bytes cortadas en espacios"""
+    step = CHUNK_SIZE - CHUNK_OVERLAP
+    text_length = len(buf)
+    return [
+        (snap_to_space(buf, start) if start else 0, snap_to_space(buf, start + CHUNK_SIZE))
+        for start in range(0, max(text_length - CHUNK_OVERLAP, 1), step)
+    ]
+
+@functools.lru_cache(maxsize=32)
+def get_chunk_matrix(tenant: str, doc_name: str, mtime_ns: int):
+    """Cuenta los términos de los fragmentos de un documento (LRU; la fecha de modificación invalida la entrada)"""
+    buf = get_document_map(tenant, doc_name)
+    spans = chunk_spans(buf)
+    matrix = VECTORIZER.transform([decode_range(buf, start, end) for start, end in spans])
+    return spans, matrix
+
+def get_relevant_context(tenant: str, doc_name: str, query: str) -> str:
+    """Arma el contexto con los fragmentos del documento más parecidos a la pregunta"""
+    buf = get_document_map(tenant, doc_name)
+    if len(buf) <= CHUNK_SIZE * CONTEXT_CHUNKS:
+        return decode_range(buf, 0, len(buf))
+    if tenant not in TRANSFORMERS_CACHE:
+        return decode_range(buf, 0, CHUNK_SIZE * CONTEXT_CHUNKS)
+    
+    mtime_ns = DOCUMENTS_CACHE[tenant][doc_name].stat().st_mtime_ns
+    spans, counts = get_chunk_matrix(tenant, doc_name, mtime_ns)
+    matrix = TRANSFORMERS_CACHE[tenant].transform(counts)
+    similarities = (matrix @ query_vector(tenant, query).T).toarray().ravel()
+    
+    # Sin coincidencias (p. ej. documento encontrado por código) se usa el inicio
+    if not similarities.any():
+        return decode_range(buf, 0, CHUNK_SIZE * CONTEXT_CHUNKS)
+    
+    top = min(CONTEXT_CHUNKS, len(spans))
+    top_indices = sorted(np.argpartition(similarities, -top)[-top:])
+    
+    # Se unen los fragmentos contiguos o solapados en orden de aparición
+    merged = []
+    for start, end in (spans[i] for i in top_indices):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    context = "\n[...]\n".join(decode_range(buf, start, end) for start, end in merged)[:MAX_CONTEXT_CHARS]
+    print(f"✂️ Contexto de {doc_name}: {len(merged)} fragmentos, {len(context):,} de {len(buf):,} bytes")
+    return context
+
 def is_meta_question(question: str) -> bool:
     """Verifica si la pregunta es sobre el sistema (meta-pregunta)"""
     q_lower = question.lower()
@@ -285,8 +1000,14 @@ def get_system_info(tenant: str) -> str:
     if not docs:
         return "No hay documentos cargados para este cliente."
     
-    total_chars = sum(len(content) for content in docs.values())
-    total_pages = len(docs)
+    # Índices guardados antes de registrar estadísticas se completan bajo demanda
+    stats = DOC_STATS.setdefault(tenant, {})
+    for name in docs:
+        if name not in stats:
+            stats[name] = document_stats(get_document_text(tenant, name))
+    
+    total_chars = sum(stats[name]["chars"] for name in docs)
+    total_pages = sum(stats[name]["pages"] for name in docs)
     doc_list = "\n".join(f"- {name}" for name in sorted(docs.keys()))
     
     return f"""📊 INFORMACIÓN DEL SISTEMA
@@ -304,20 +1025,40 @@ def check_hallucination(answer: str, doc_name: str, doc_content: str) -> bool:
         return False
     
     # Buscar referencias a otros documentos
-    other_doc_patterns = [
-        r'GAM-SIG-PR-\d+',
-        r'DESPA-PG',
-        r'G_\d{3}_\d{4}',
-        r'[\w\s]*\.pdf'
-    ]
-    
-    for pattern in other_doc_patterns:
-        matches = re.findall(pattern, answer, re.IGNORECASE)
-        for match in matches:
-            if match not in doc_name and match not in doc_content:
-                return True
-    
-    return False
+    return any(
+        match.group(0) not in doc_name and match.group(0) not in doc_content
+        for match in HALLUC_RE.finditer(answer)
+    )
+
+# ============= CACHÉ DE RESPUESTAS =============
+def answer_cache_key(tenant: str, question: str) -> tuple:
+    """Clave de caché ligada a la versión actual del corpus del tenant"""
+    digest = hashlib.blake2b(question.encode('utf-8'), digest_size=16).digest()
+    return (tenant, CORPUS_VERSION.get(tenant, 0), digest)
+
+def stored_answer_key(doc_name: str, doc_hash: str, question: str) -> str:
+    """Clave persistente: cambia si el texto del documento cambia"""
+    normalized = question.strip().lower()
+    return hashlib.sha1(f"{doc_name}\x00{doc_hash}\x00{normalized}".encode('utf-8')).hexdigest()
+
+def get_cached_answer(key: tuple):
+    """Devuelve la respuesta cacheada (y la marca como reciente) o None si no existe o expiró"""
+    cached = ANSWER_CACHE.get(key)
+    if cached is None:
+        return None
+    expires, entry = cached
+    if expires < time.monotonic():
+        del ANSWER_CACHE[key]
+        return None
+    ANSWER_CACHE.move_to_end(key)
+    return entry
+
+def cache_answer(key: tuple, entry: dict):
+    """Guarda una respuesta expulsando la menos usada si se supera el límite"""
+    ANSWER_CACHE[key] = (time.monotonic() + ANSWER_CACHE_TTL, entry)
+    ANSWER_CACHE.move_to_end(key)
+    if len(ANSWER_CACHE) > ANSWER_CACHE_SIZE:
+        ANSWER_CACHE.popitem(last=False)
 
 # ============= HTML INTERFACE =============
 HTML = """
@@ -414,6 +1155,7 @@ function addMsg(role, text) {
   
   messagesEl.appendChild(div);
   messagesEl.scrollTop = messagesEl.scrollHeight;
+  return textEl;
 }
 
 async function loadDocuments() {
@@ -495,8 +1237,39 @@ document.getElementById('askBtn').onclick = async () => {
     const res = await fetch('/ask', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({ tenant, question: q })
+      body: JSON.stringify({ tenant, question: q, stream: true })
     });
+    
+    // Las respuestas generadas llegan por fragmentos (una línea JSON por evento)
+    if ((res.headers.get('Content-Type') || '').includes('application/x-ndjson')) {
+      const textEl = addMsg('assistant', '');
+      const reader = res.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let answer = '';
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+          if (!line) continue;
+          const event = JSON.parse(line);
+          if (event.delta) {
+            answer += event.delta;
+            textEl.innerHTML = answer.replace(/\\n/g, '<br>');
+          } else if (event.ok) {
+            textEl.innerHTML = `${event.answer}\\n\\n📄 Fuente: ${event.source}`.replace(/\\n/g, '<br>');
+          } else {
+            textEl.innerHTML = `❌ ${event.error}`;
+          }
+          messagesEl.scrollTop = messagesEl.scrollHeight;
+        }
+      }
+      return;
+    }
+    
     const data = await res.json();
     
     if (data.ok) {
@@ -592,121 +1365,228 @@ async def root():
 async def get_docs(tenant: str):
     try:
         if tenant not in DOCUMENTS_CACHE:
-            load_documents_from_disk()
+            await asyncio.to_thread(ensure_tenant_loaded, tenant)
         
         if tenant not in DOCUMENTS_CACHE or not DOCUMENTS_CACHE[tenant]:
             return {"ok": True, "documents": []}
         
         docs = DOCUMENTS_CACHE[tenant]
-        doc_list = [[name, len(content)] for name, content in docs.items()]
+        doc_list = [[name, txt_path.stat().st_size] for name, txt_path in docs.items()]
         return {"ok": True, "documents": doc_list}
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+def store_uploaded_documents(tenant: str, metadata_rows: list, new_docs: dict):
+    """Guarda metadatos e indexa los documentos subidos que sigan existiendo, bajo el lock del tenant"""
+    with tenant_lock(tenant):
+        # Los documentos borrados desde la respuesta de /upload no vuelven a la BD
+        docs = DOCUMENTS_CACHE.get(tenant, {})
+        metadata_rows = [row for row in metadata_rows if row[0] in docs]
+        
+        # Guardar metadatos de todo el lote en una transacción
+        if metadata_rows:
+            save_document_metadata(tenant, metadata_rows)
+        
+        # Agregar al índice solo los archivos nuevos o modificados
+        if new_docs:
+            add_doc_embeddings(tenant, new_docs)
+
+async def index_uploaded_documents(tenant: str, metadata_rows: list, new_docs: dict):
+    """Guarda metadatos e indexa los documentos subidos después de responder"""
+    try:
+        await asyncio.to_thread(store_uploaded_documents, tenant, metadata_rows, new_docs)
+    except Exception as e:
+        print(f"❌ Error indexando documentos de {tenant}: {e}")
+        import traceback
+        traceback.print_exc()
+    finally:
+        INDEXING_STATUS[tenant] -= 1
+        if INDEXING_STATUS[tenant] <= 0:
+            del INDEXING_STATUS[tenant]
 
 @app.post("/upload")
-async def upload(tenant: str = Form(...), files: list[UploadFile] = File(None)):
+async def upload(background_tasks: BackgroundTasks, tenant: str = Form(...), files: list[UploadFile] = File(None)):
     try:
         tenant = (tenant or "").strip()
         if not tenant:
-            return JSONResponse({"ok": False, "error": "tenant requerido"}, status_code=400)
+            return ORJSONResponse({"ok": False, "error": "tenant requerido"}, status_code=400)
         
-        init_db(tenant)
         tenant_dir = DATA_DIR / tenant
         tenant_dir.mkdir(exist_ok=True)
         
         if tenant not in DOCUMENTS_CACHE:
-            DOCUMENTS_CACHE[tenant] = {}
+            await asyncio.to_thread(ensure_tenant_loaded, tenant)
+            DOCUMENTS_CACHE.setdefault(tenant, {})
         
         uploaded_files = []
+        new_docs = {}
+        metadata_rows = []
         
         # Si no hay archivos, retornar error
         if not files:
-            return JSONResponse({"ok": False, "error": "No files provided"}, status_code=400)
+            return ORJSONResponse({"ok": False, "error": "No files provided"}, status_code=400)
         
         # Asegurar que files es una lista
         if not isinstance(files, list):
             files = [files]
         
+        # Guardar todos los archivos antes de extraer el texto en paralelo
+        pending = []
         for file in files:
             # Validar que el archivo tenga nombre
             if not file or not hasattr(file, 'filename') or not file.filename:
                 continue
             
             try:
-                # Leer el contenido del archivo
-                file_content = await file.read()
-                
-                # Guardar el archivo
+                # Guardar el archivo por bloques, sin cargarlo completo en memoria
                 out_path = tenant_dir / file.filename
-                with open(out_path, 'wb') as f:
-                    f.write(file_content)
+                content_hash = await save_upload(file, out_path)
                 
-                # Extraer texto del PDF
-                text_content, page_count = extract_text_from_pdf(str(out_path))
+                # Omitir documentos cuyo contenido no cambió
+                if (file.filename in DOCUMENTS_CACHE[tenant]
+                        and await asyncio.to_thread(get_document_hash, tenant, file.filename) == content_hash):
+                    uploaded_files.append(file.filename)
+                    print(f"⏭️ {file.filename} sin cambios, se omite")
+                    continue
                 
+                pending.append((file.filename, out_path, content_hash))
+            except Exception as file_err:
+                print(f"❌ Error guardando {file.filename}: {file_err}")
+                import traceback
+                traceback.print_exc()
+        
+        # Extraer texto de los PDFs
+        jobs = [(str(out_path), tenant, content_hash) for _, out_path, content_hash in pending]
+        plans, tasks = await asyncio.to_thread(plan_pdf_extraction, jobs)
+        loop = asyncio.get_running_loop()
+        task_results = await asyncio.gather(
+            *(loop.run_in_executor(PDF_POOL, parse_pdf_pages, task) for task in tasks)
+        )
+        results = await asyncio.to_thread(finish_pdf_extraction, plans, task_results)
+        
+        for (filename, out_path, content_hash), (text_content, page_count) in zip(pending, results):
+            try:
                 if text_content.strip():
-                    # Guardar en caché
-                    DOCUMENTS_CACHE[tenant][file.filename] = text_content
-                    uploaded_files.append(file.filename)
-                    
-                    # Guardar archivo de texto
+                    # Guardar archivo de texto y registrarlo en caché
                     txt_path = tenant_dir / (out_path.stem + ".txt")
-                    with open(txt_path, 'w', encoding='utf-8') as f:
-                        f.write(text_content)
+                    tmp_path = txt_path.with_suffix(".txt.tmp")
+                    async with aiofiles.open(tmp_path, 'w', encoding='utf-8') as f:
+                        await f.write(text_content)
+                    os.replace(tmp_path, txt_path)
+                    DOCUMENTS_CACHE[tenant][filename] = txt_path
+                    uploaded_files.append(filename)
+                    new_docs[filename] = text_content
                     
-                    # Guardar metadatos
                     file_size = out_path.stat().st_size
-                    save_document_metadata(tenant, file.filename, file_size, page_count)
+                    metadata_rows.append((filename, file_size, page_count, content_hash))
                     
-                    print(f"✅ {file.filename} procesado exitosamente")
+                    print(f"✅ {filename} procesado exitosamente")
                 else:
-                    print(f"⚠️ {file.filename} no contiene texto")
+                    print(f"⚠️ {filename} no contiene texto")
                     
             except Exception as file_err:
-                print(f"❌ Error procesando {file.filename}: {file_err}")
+                print(f"❌ Error procesando {filename}: {file_err}")
                 import traceback
                 traceback.print_exc()
                 continue
         
-        # Crear embeddings si hay archivos
-        if uploaded_files:
-            create_embeddings(tenant)
+        # Indexar en segundo plano para responder sin esperar al índice
+        if metadata_rows or new_docs:
+            INDEXING_STATUS[tenant] += 1
+            background_tasks.add_task(index_uploaded_documents, tenant, metadata_rows, new_docs)
         
         return {"ok": True, "files": uploaded_files}
     except Exception as e:
         print(f"❌ Error en /upload: {e}")
         import traceback
         traceback.print_exc()
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+async def finish_answer(tenant: str, question: str, answer: str, doc_name: str, doc_content: str, cache_key: tuple, stored_key: str) -> str:
+    """Valida la respuesta generada, la guarda en caché y la registra en el historial"""
+    answer = answer or "No se pudo generar una respuesta"
+    
+    if check_hallucination(answer, doc_name, doc_content):
+        answer = "⚠️ La respuesta podría contener información no verificada. Por favor, revisa el documento original."
+    else:
+        cache_answer(cache_key, {"answer": answer, "source": doc_name})
+        if stored_key:
+            await asyncio.to_thread(store_answer, tenant, stored_key, doc_name, answer)
+    
+    save_conversation(tenant, question, answer, [doc_name])
+    return answer
+
+def chunk_text(chunk) -> str:
+    """Texto de un fragmento de Gemini; vacío si no trae partes (p. ej. solo STOP o bloqueo)"""
+    if not chunk.candidates:
+        return ""
+    return "".join(part.text for part in chunk.candidates[0].content.parts)
+
+async def stream_answer(tenant: str, question: str, prompt: str, doc_name: str, doc_content: str, cache_key: tuple, stored_key: str):
+    """Envía la respuesta de Gemini por fragmentos (NDJSON) y la registra al terminar"""
+    parts = []
+    try:
+        response = await model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            text = chunk_text(chunk)
+            if text:
+                parts.append(text)
+                yield orjson.dumps({"delta": text}) + b"\n"
+        
+        answer = await finish_answer(tenant, question, "".join(parts), doc_name, doc_content, cache_key, stored_key)
+        yield orjson.dumps({"ok": True, "answer": answer, "source": doc_name}) + b"\n"
+    except Exception as e:
+        yield orjson.dumps({"ok": False, "error": str(e)}) + b"\n"
 
 @app.post("/ask")
 async def ask(data: dict):
     try:
         tenant = (data.get("tenant") or "").strip()
         question = (data.get("question") or "").strip()
+        stream = bool(data.get("stream"))
         
         if not tenant:
-            return JSONResponse({"ok": False, "error": "tenant requerido"}, status_code=400)
+            return ORJSONResponse({"ok": False, "error": "tenant requerido"}, status_code=400)
         if not question:
-            return JSONResponse({"ok": False, "error": "question requerido"}, status_code=400)
+            return ORJSONResponse({"ok": False, "error": "question requerido"}, status_code=400)
         
         if tenant not in DOCUMENTS_CACHE:
-            load_documents_from_disk()
+            await asyncio.to_thread(ensure_tenant_loaded, tenant)
         
         if tenant not in DOCUMENTS_CACHE or not DOCUMENTS_CACHE[tenant]:
             return {"ok": False, "error": "No hay documentos cargados para este cliente"}
         
+        if INDEXING_STATUS[tenant]:
+            return {"ok": False, "error": "Reindexando documentos, intenta de nuevo en unos segundos"}
+        
         if is_meta_question(question):
             answer = get_system_info(tenant)
             return {"ok": True, "answer": answer, "source": "Sistema"}
         
-        relevant_docs = search_relevant_documents(tenant, question, top_k=1)
+        cache_key = answer_cache_key(tenant, question)
+        cached = get_cached_answer(cache_key)
+        if cached is not None:
+            save_conversation(tenant, question, cached["answer"], [cached["source"]])
+            return {"ok": True, **cached}
+        
+        relevant_docs = await asyncio.to_thread(search_relevant_documents, tenant, question, 1)
         
         if not relevant_docs:
             return {"ok": False, "error": "No se encontraron documentos relevantes"}
         
         doc_name = relevant_docs[0]
-        doc_content = DOCUMENTS_CACHE[tenant][doc_name]
+        
+        # Respuesta guardada en SQLite para este documento y esta pregunta
+        doc_hash = DOC_HASHES.get(tenant, {}).get(doc_name)
+        stored_key = stored_answer_key(doc_name, doc_hash, question) if doc_hash else None
+        if stored_key:
+            stored = await asyncio.to_thread(get_stored_answer, tenant, stored_key)
+            if stored is not None:
+                cache_answer(cache_key, {"answer": stored, "source": doc_name})
+                save_conversation(tenant, question, stored, [doc_name])
+                return {"ok": True, "answer": stored, "source": doc_name}
+        
+        doc_content = await asyncio.to_thread(get_relevant_context, tenant, doc_name, question)
         
         prompt = f"""Eres un asistente experto. Responde la siguiente pregunta basándote ÚNICAMENTE en el contenido del documento proporcionado.
 
@@ -722,63 +1602,93 @@ INSTRUCCIONES:
 - NO inventes información
 - NO hagas referencias a otros documentos que no estén en el contenido proporcionado"""
         
-        response = model.generate_content(prompt)
-        answer = response.text if response.text else "No se pudo generar una respuesta"
-        
-        if check_hallucination(answer, doc_name, doc_content):
-            answer = "⚠️ La respuesta podría contener información no verificada. Por favor, revisa el documento original."
+        if stream:
+            return StreamingResponse(
+                stream_answer(tenant, question, prompt, doc_name, doc_content, cache_key, stored_key),
+                media_type="application/x-ndjson",
+            )
         
-        save_conversation(tenant, question, answer, [doc_name])
+        response = await model.generate_content_async(prompt)
+        answer = await finish_answer(tenant, question, response.text, doc_name, doc_content, cache_key, stored_key)
         
         return {"ok": True, "answer": answer, "source": doc_name}
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.get("/history")
 async def history(tenant: str):
     try:
-        history = get_conversation_history(tenant)
+        history = await asyncio.to_thread(get_conversation_history, tenant)
         return {"ok": True, "history": history}
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
-@app.post("/delete-document")
-async def delete_document(tenant: str = Form(...), filename: str = Form(...)):
+@app.post("/reload-documents")
+async def reload_documents():
     try:
+        await asyncio.to_thread(load_documents_from_disk)
+        return {"ok": True, "tenants": {tenant: len(docs) for tenant, docs in DOCUMENTS_CACHE.items()}}
+    except Exception as e:
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
+
+def remove_document(tenant: str, filename: str):
+    """Borra un documento del disco, la BD y el índice bajo el lock del tenant"""
+    with tenant_lock(tenant):
         tenant_dir = DATA_DIR / tenant
         pdf_path = tenant_dir / filename
         txt_path = tenant_dir / (Path(filename).stem + ".txt")
         
+        # Huella del PDF para borrar también su texto de la caché de extracción
+        content_hash = get_document_hash(tenant, filename)
+        if content_hash is None and pdf_path.exists():
+            content_hash = file_fingerprint(str(pdf_path))
+        if content_hash:
+            delete_cached_text(tenant, content_hash)
+        
         if pdf_path.exists():
             pdf_path.unlink()
         if txt_path.exists():
             txt_path.unlink()
         
+        delete_document_metadata(tenant, filename)
+        
         if tenant in DOCUMENTS_CACHE and filename in DOCUMENTS_CACHE[tenant]:
             del DOCUMENTS_CACHE[tenant][filename]
-            create_embeddings(tenant)
+            remove_doc_embedding(tenant, filename)
+
+def remove_tenant(tenant: str):
+    """Borra todos los documentos y datos de un tenant bajo su lock"""
+    with tenant_lock(tenant):
+        tenant_dir = DATA_DIR / tenant
+        if tenant_dir.exists():
+            # Renombrar es atómico e inmediato; el borrado real ocurre en segundo plano
+            TRASH_DIR.mkdir(exist_ok=True)
+            os.rename(tenant_dir, TRASH_DIR / f"{tenant}-{uuid4().hex}")
+        
+        delete_tenant_data(tenant)
+        shutil.rmtree(DB_DIR / tenant / "cache", ignore_errors=True)
         
+        if tenant in DOCUMENTS_CACHE:
+            del DOCUMENTS_CACHE[tenant]
+        clear_embeddings(tenant)
+        for index in (NAME_INDEX, NAME_BLOB, CODE_INDEX, WORD_INDEX):
+            index.pop(tenant, None)
+
+@app.post("/delete-document")
+async def delete_document(tenant: str = Form(...), filename: str = Form(...)):
+    try:
+        await asyncio.to_thread(remove_document, tenant, filename)
         return {"ok": True}
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 @app.post("/delete-all-documents")
 async def delete_all_documents(tenant: str = Form(...)):
     try:
-        tenant_dir = DATA_DIR / tenant
-        if tenant_dir.exists():
-            shutil.rmtree(str(tenant_dir))
-        
-        if tenant in DOCUMENTS_CACHE:
-            del DOCUMENTS_CACHE[tenant]
-        if tenant in VECTORIZERS_CACHE:
-            del VECTORIZERS_CACHE[tenant]
-        if tenant in EMBEDDINGS_CACHE:
-            del EMBEDDINGS_CACHE[tenant]
-        
+        await asyncio.to_thread(remove_tenant, tenant)
         return {"ok": True}
     except Exception as e:
-        return JSONResponse({"ok": False, "error": str(e)}, status_code=500)
+        return ORJSONResponse({"ok": False, "error": str(e)}, status_code=500)
 
 if __name__ == "__main__":
     import uvicorn
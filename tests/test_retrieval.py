@@ -0,0 +1,66 @@
+"""Recuperación por contenido sobre los PDFs de ejemplo del repositorio"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+TENANT = "demo"
+LIFE_CONTRACT = "BF00749438_LIFE_CONTRACT_15_3890_20231212.pdf"
+FEE_RECEIPT = "BMI BF00749438_FEE_OFFICIAL_RECEIPT_2528809.pdf"
+
+
+class RetrievalTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # app.py crea data/ y db/ en el directorio actual al importarse
+        cls.cwd = os.getcwd()
+        cls.work_dir = tempfile.mkdtemp()
+        os.chdir(cls.work_dir)
+        tenant_dir = Path("data") / TENANT
+        tenant_dir.mkdir(parents=True)
+        for pdf in REPO_DIR.glob("*.pdf"):
+            shutil.copy(pdf, tenant_dir / pdf.name)
+
+        os.environ.setdefault("GOOGLE_API_KEY", "test")
+        sys.path.insert(0, str(REPO_DIR))
+        import app
+        cls.app = app
+        app.load_tenant(TENANT)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.close_all_connections()
+        os.chdir(cls.cwd)
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def search(self, question: str) -> list:
+        return self.app.search_relevant_documents(TENANT, question)
+
+    def best_score(self, question: str) -> float:
+        query_vec = self.app.query_vector(TENANT, question)
+        return float((self.app.EMBEDDINGS_CACHE[TENANT] @ query_vec.T).max())
+
+    def test_finds_life_contract_by_content(self):
+        self.assertEqual(self.search("¿Cuál es la prima del seguro de vida?"), [LIFE_CONTRACT])
+        self.assertEqual(self.search("policy owner"), [LIFE_CONTRACT])
+
+    def test_finds_receipt_by_content(self):
+        self.assertEqual(self.search("cargo por administración casa matriz"), [FEE_RECEIPT])
+
+    def test_unrelated_question_finds_nothing(self):
+        self.assertEqual(self.search("receta de paella"), [])
+
+    def test_threshold_keeps_a_margin_on_both_sides(self):
+        # Pregunta real con la puntuación más baja y pregunta ajena con la más alta
+        threshold = self.app.SIMILARITY_THRESHOLD
+        self.assertGreaterEqual(self.best_score("¿quién es el asegurado?"), threshold * 1.4)
+        self.assertLessEqual(self.best_score("resultado del partido de fútbol"), threshold * 0.8)
+        self.assertEqual(self.search("¿quién es el asegurado?"), [LIFE_CONTRACT])
+        self.assertEqual(self.search("resultado del partido de fútbol"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()